@@ -1,9 +1,16 @@
 import os
+import time
+_START_TIME = time.perf_counter()
+
 import discord
 from discord.ext import commands
 from discord import app_commands
 import asyncio
-import yt_dlp
+import atexit
+import hashlib
+import heapq
+import itertools
+import math
 from dotenv import load_dotenv
 import logging
 import traceback
@@ -11,7 +18,19 @@ from flask import Flask, request, jsonify
 from threading import Thread
 import logging
 import json
+import queue as queue_module
+import sqlite3
 import sys
+import threading
+import uuid
+from collections import Counter
+from contextlib import contextmanager
+from typing import NamedTuple, Optional
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
 
 # --- Basic Logging Setup ---
 logging.basicConfig(level=logging.INFO, format='%(asctime)s:%(levelname)s:%(name)s: %(message)s')
@@ -21,6 +40,21 @@ log = logging.getLogger(__name__)
 load_dotenv()
 TOKEN = os.getenv('TOKEN')
 API_TOKEN = os.getenv('API_TOKEN', 'SECRET_API_TOKEN')  # Secret pour l'API
+FAST_START = os.getenv('FAST_START', '0').lower() in ('1', 'true', 'yes')  # pas de préchargement de yt_dlp
+TREE_HASH_FILE = os.getenv('TREE_HASH_FILE', '.command_tree_hash')
+QUEUE_MODE = os.getenv('QUEUE_MODE', 'fifo').lower()  # 'fifo' ou 'fair'
+# Poids par défaut en mode 'fair' : "id_utilisateur:poids,Dashboard:0.5"
+FAIR_QUEUE_WEIGHTS = os.getenv('FAIR_QUEUE_WEIGHTS', '')
+
+# --- Resource Limits (0 = illimité) ---
+MAX_STREAMS = int(os.getenv('MAX_STREAMS', '0'))  # sessions vocales simultanées
+MAX_FFMPEG = int(os.getenv('MAX_FFMPEG', '0'))  # processus ffmpeg (morceaux en cours + en file)
+MAX_EXTRACTIONS = int(os.getenv('MAX_EXTRACTIONS', '4'))  # extractions yt_dlp simultanées
+MAX_CPU_PERCENT = float(os.getenv('MAX_CPU_PERCENT', '0'))
+MAX_RSS_MB = float(os.getenv('MAX_RSS_MB', '0'))
+
+HISTORY_DB = os.getenv('HISTORY_DB', 'history.db')  # historique des lectures (SQLite)
+MAX_STATS_HOURS = 24 * 30  # période maximale des endpoints /stats
 
 if not TOKEN:
     log.error("ERROR: Discord TOKEN not found in .env file.")
@@ -51,7 +85,26 @@ ffmpeg_options = {
     'options': '-vn -filter:a "volume=0.25" -bufsize 4096k'  # Buffer augmenté pour stabilité
 }
 
-ytdl = yt_dlp.YoutubeDL(ytdl_format_options)
+# Format moins gourmand utilisé quand l'hôte est sous pression
+LOW_QUALITY_FORMAT = 'bestaudio[abr<=64]/worstaudio/bestaudio/best'
+
+# yt_dlp charge des centaines d'extracteurs : import différé au premier usage.
+# Bloquant (plusieurs secondes) : à appeler via run_in_executor, jamais sur la boucle.
+_ytdl = {}  # low_quality -> instance YoutubeDL
+_ytdl_lock = threading.Lock()
+
+def get_ytdl(low_quality=False):
+    with _ytdl_lock:
+        if low_quality in _ytdl:
+            return _ytdl[low_quality]
+        t0 = time.perf_counter()
+        import yt_dlp
+        options = dict(ytdl_format_options)
+        if low_quality:
+            options['format'] = LOW_QUALITY_FORMAT
+        _ytdl[low_quality] = yt_dlp.YoutubeDL(options)
+        log.info(f"yt_dlp loaded in {time.perf_counter() - t0:.2f}s")
+        return _ytdl[low_quality]
 
 # --- Intents ---
 intents = discord.Intents.default()
@@ -75,6 +128,343 @@ log.setLevel(logging.ERROR)
 # --- Global Player Dictionary ---
 players = {}  # guild_id: MusicPlayer instance
 
+# --- Resource Governor ---
+class ResourceBusy(Exception):
+    """Levée quand une nouvelle demande est refusée faute de ressources"""
+
+class ResourceGovernor:
+    """Contrôle d'admission : refuse les nouvelles demandes avant de dégrader la lecture.
+
+    Ordre de délestage : extractions (nouveaux morceaux) puis nouvelles sessions ;
+    les lectures en cours ne sont jamais interrompues.
+    """
+    SAMPLE_INTERVAL = 2.0  # secondes entre deux mesures CPU/RAM
+    SOFT_RATIO = 0.8  # au-delà, qualité réduite
+
+    def __init__(self):
+        self.sessions = 0  # sessions réservées (connexion en cours ou player actif)
+        self.extractions = 0
+        self._sampled_at = 0.0
+        self._cpu = None
+        self._rss_mb = None
+        self._process = psutil.Process() if psutil else None
+
+    def _sample(self):
+        now = time.monotonic()
+        if now - self._sampled_at < self.SAMPLE_INTERVAL:
+            return
+        self._sampled_at = now
+        if self._process:
+            self._cpu = psutil.cpu_percent(interval=None)
+            self._rss_mb = self._process.memory_info().rss / (1024 * 1024)
+            return
+        try:
+            self._cpu = os.getloadavg()[0] / (os.cpu_count() or 1) * 100
+        except (AttributeError, OSError):
+            self._cpu = None
+        try:
+            with open('/proc/self/statm') as f:
+                self._rss_mb = int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / (1024 * 1024)
+        except (OSError, ValueError, AttributeError):
+            self._rss_mb = None
+
+    def active_streams(self):
+        return self.sessions
+
+    def ffmpeg_processes(self):
+        # Chaque YTDLSource lance son ffmpeg dès sa création
+        return sum(p.queue.qsize() + (1 if p.current_source else 0) for p in list(players.values()))
+
+    def _ratios(self):
+        self._sample()
+        ratios = {}
+        if MAX_STREAMS:
+            ratios['streams'] = self.active_streams() / MAX_STREAMS
+        if MAX_FFMPEG:
+            ratios['ffmpeg'] = self.ffmpeg_processes() / MAX_FFMPEG
+        if MAX_CPU_PERCENT and self._cpu is not None:
+            ratios['cpu'] = self._cpu / MAX_CPU_PERCENT
+        if MAX_RSS_MB and self._rss_mb is not None:
+            ratios['rss'] = self._rss_mb / MAX_RSS_MB
+        return ratios
+
+    def _exhausted(self, *keys):
+        ratios = self._ratios()
+        return [key for key in keys if ratios.get(key, 0) >= 1]
+
+    def under_pressure(self):
+        return any(r >= self.SOFT_RATIO for r in self._ratios().values())
+
+    def _check_extraction(self):
+        if MAX_EXTRACTIONS and self.extractions >= MAX_EXTRACTIONS:
+            raise ResourceBusy("Too many songs are being resolved right now. Please try again in a moment.")
+        exhausted = self._exhausted('ffmpeg', 'cpu', 'rss')
+        if exhausted:
+            raise ResourceBusy(f"Bot is busy ({', '.join(exhausted)} limit reached). Please try again later.")
+
+    def admit_session(self):
+        """Réserve une session ; à libérer via release_session() (échec de connexion ou destroy)"""
+        exhausted = self._exhausted('streams')
+        if exhausted:
+            raise ResourceBusy(f"Bot is busy ({', '.join(exhausted)} limit reached). Please try again later.")
+        # Inutile de rejoindre le salon si le premier morceau ne peut pas être résolu
+        self._check_extraction()
+        self.sessions += 1
+
+    def release_session(self):
+        self.sessions = max(0, self.sessions - 1)
+
+    @contextmanager
+    def extraction(self):
+        self._check_extraction()
+        self.extractions += 1
+        try:
+            yield
+        finally:
+            self.extractions -= 1
+
+    def headroom(self):
+        ratios = self._ratios()
+        return {
+            "streams": {"active": self.active_streams(), "max": MAX_STREAMS or None},
+            "ffmpeg": {"active": self.ffmpeg_processes(), "max": MAX_FFMPEG or None},
+            "extractions": {"active": self.extractions, "max": MAX_EXTRACTIONS or None},
+            "cpu_percent": {"current": self._cpu, "max": MAX_CPU_PERCENT or None},
+            "rss_mb": {"current": round(self._rss_mb, 1) if self._rss_mb is not None else None, "max": MAX_RSS_MB or None},
+            "under_pressure": any(r >= self.SOFT_RATIO for r in ratios.values()),
+            "exhausted": [key for key, r in ratios.items() if r >= 1]
+        }
+
+governor = ResourceGovernor()
+
+# --- Play History Store ---
+class HistoryStore:
+    """Historique des lectures dans SQLite, alimenté par un thread d'écriture par lots.
+
+    record() ne bloque jamais la boucle d'événements : les événements passent par
+    une file bornée et sont insérés par lots dans une seule transaction.
+    Les agrégats (track_stats, concurrency_minutes, ttfa_hist) sont mis à jour dans
+    cette même transaction : les requêtes de stats ne lisent jamais la table plays.
+    La base est ouverte par le thread d'écriture, jamais à l'import du module.
+    """
+    BATCH_SIZE = 200
+    FLUSH_INTERVAL = 2.0  # secondes
+    MAX_PENDING = 10000
+    MAX_TRACK_MINUTES = 24 * 60  # borne le nombre de minutes comptées par lecture
+    PRESENCE_SLACK_MINUTES = 60  # marge avant purge de guild_minutes
+    TTFA_BUCKET_BASE = 1.1  # seaux logarithmiques : p95 précis à 10 % près
+    ALL_GUILDS = 0  # guild_id des agrégats tous serveurs confondus
+
+    SCHEMA = """
+        PRAGMA journal_mode=WAL;
+        CREATE TABLE IF NOT EXISTS plays (
+            id INTEGER PRIMARY KEY,
+            guild_id INTEGER NOT NULL,
+            track_id TEXT NOT NULL,
+            title TEXT,
+            requester TEXT,
+            started_at REAL NOT NULL,
+            ended_at REAL NOT NULL,
+            listened REAL NOT NULL,
+            skipped INTEGER NOT NULL,
+            resolution_ms REAL,
+            ended_reason TEXT NOT NULL DEFAULT 'finished',
+            ttfa_ms REAL
+        );
+        CREATE INDEX IF NOT EXISTS plays_guild_started ON plays (guild_id, started_at);
+        CREATE TABLE IF NOT EXISTS track_stats (
+            guild_id INTEGER NOT NULL,
+            track_id TEXT NOT NULL,
+            title TEXT,
+            plays INTEGER NOT NULL DEFAULT 0,
+            skips INTEGER NOT NULL DEFAULT 0,
+            listened REAL NOT NULL DEFAULT 0,
+            PRIMARY KEY (guild_id, track_id)
+        );
+        CREATE INDEX IF NOT EXISTS track_stats_top ON track_stats (guild_id, plays DESC);
+        CREATE TABLE IF NOT EXISTS guild_minutes (
+            minute INTEGER NOT NULL,  -- epoch // 60
+            guild_id INTEGER NOT NULL,
+            PRIMARY KEY (minute, guild_id)
+        ) WITHOUT ROWID;
+        CREATE TABLE IF NOT EXISTS concurrency_minutes (
+            minute INTEGER PRIMARY KEY,  -- epoch // 60
+            guilds INTEGER NOT NULL  -- serveurs ayant joué pendant cette minute
+        );
+        CREATE TABLE IF NOT EXISTS ttfa_hist (
+            guild_id INTEGER NOT NULL,
+            hour INTEGER NOT NULL,  -- epoch // 3600
+            bucket INTEGER NOT NULL,
+            count INTEGER NOT NULL,
+            PRIMARY KEY (guild_id, hour, bucket)
+        );
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._pending = queue_module.Queue(maxsize=self.MAX_PENDING)
+        self._readers = threading.local()
+        self._ready = threading.Event()  # schéma créé par le thread d'écriture
+        self._thread = None
+        self._latest_minute = 0  # minute de fin la plus récente vue par _write
+
+    def start(self):
+        self._thread = Thread(target=self._run, name='history-writer', daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def close(self):
+        if self._thread and self._thread.is_alive():
+            self._pending.put(None)
+            self._thread.join(timeout=5)
+
+    def record(self, event: dict):
+        try:
+            self._pending.put_nowait(event)
+        except queue_module.Full:
+            log.warning("History queue full, dropping play event.")
+
+    def _run(self):
+        conn = sqlite3.connect(self.path)
+        conn.executescript(self.SCHEMA)
+        self._ready.set()
+        running = True
+        while running:
+            batch = []
+            try:
+                event = self._pending.get(timeout=self.FLUSH_INTERVAL)
+                while event is not None:
+                    batch.append(event)
+                    if len(batch) >= self.BATCH_SIZE:
+                        break
+                    event = self._pending.get_nowait()
+                else:
+                    running = False
+            except queue_module.Empty:
+                pass
+            if batch:
+                try:
+                    self._write(conn, batch)
+                except sqlite3.Error as e:
+                    log.error(f"Failed to write {len(batch)} play events: {e}")
+        conn.close()
+
+    @classmethod
+    def ttfa_bucket(cls, ms):
+        return int(math.log(max(ms, 1.0), cls.TTFA_BUCKET_BASE))
+
+    def _write(self, conn, batch):
+        presence = set()  # (minute, guild_id) : un serveur compte une fois par minute
+        ttfa = Counter()
+        for event in batch:
+            last = int(event["ended_at"] // 60)
+            first = max(int(event["started_at"] // 60), last - self.MAX_TRACK_MINUTES)
+            presence.update((minute, event["guild_id"]) for minute in range(first, last + 1))
+            self._latest_minute = max(self._latest_minute, last)
+            if event["ttfa_ms"] is not None:
+                hour = int(event["started_at"] // 3600)
+                bucket = self.ttfa_bucket(event["ttfa_ms"])
+                ttfa[(event["guild_id"], hour, bucket)] += 1
+                ttfa[(self.ALL_GUILDS, hour, bucket)] += 1
+
+        with conn:
+            # Seules les présences nouvelles incrémentent le nombre de serveurs de la minute
+            guilds = Counter()
+            for minute, guild_id in presence:
+                cursor = conn.execute(
+                    "INSERT OR IGNORE INTO guild_minutes (minute, guild_id) VALUES (?, ?)",
+                    (minute, guild_id)
+                )
+                if cursor.rowcount:
+                    guilds[minute] += 1
+            conn.executemany(
+                """INSERT INTO concurrency_minutes (minute, guilds) VALUES (?, ?)
+                   ON CONFLICT (minute) DO UPDATE SET guilds = guilds + excluded.guilds""",
+                guilds.items()
+            )
+            # Les nouvelles lectures ne peuvent plus toucher ces minutes : inutile de les garder
+            conn.execute(
+                "DELETE FROM guild_minutes WHERE minute < ?",
+                (self._latest_minute - self.MAX_TRACK_MINUTES - self.PRESENCE_SLACK_MINUTES,)
+            )
+            conn.executemany(
+                """INSERT INTO plays (guild_id, track_id, title, requester, started_at, ended_at,
+                                      listened, skipped, resolution_ms, ended_reason, ttfa_ms)
+                   VALUES (:guild_id, :track_id, :title, :requester, :started_at, :ended_at,
+                           :listened, :skipped, :resolution_ms, :ended_reason, :ttfa_ms)""",
+                batch
+            )
+            conn.executemany(
+                """INSERT INTO track_stats (guild_id, track_id, title, plays, skips, listened)
+                   VALUES (:guild_id, :track_id, :title, 1, :skipped, :listened)
+                   ON CONFLICT (guild_id, track_id) DO UPDATE SET
+                       title = excluded.title,
+                       plays = plays + 1,
+                       skips = skips + excluded.skips,
+                       listened = listened + excluded.listened""",
+                [event for event in batch if event["ended_reason"] != 'error']
+            )
+            conn.executemany(
+                """INSERT INTO ttfa_hist (guild_id, hour, bucket, count) VALUES (?, ?, ?, ?)
+                   ON CONFLICT (guild_id, hour, bucket) DO UPDATE SET count = count + excluded.count""",
+                [(*key, count) for key, count in ttfa.items()]
+            )
+
+    def _reader(self):
+        # Une connexion en lecture par thread Flask (WAL : pas de blocage de l'écrivain)
+        conn = getattr(self._readers, 'conn', None)
+        if conn is None:
+            if not self._ready.wait(timeout=5):
+                raise sqlite3.OperationalError("History store is not started.")
+            conn = sqlite3.connect(self.path)
+            conn.row_factory = sqlite3.Row
+            self._readers.conn = conn
+        return conn
+
+    def top_tracks(self, guild_id, limit=10):
+        rows = self._reader().execute(
+            """SELECT track_id, title, plays, skips, listened FROM track_stats
+               WHERE guild_id = ? ORDER BY plays DESC LIMIT ?""",
+            (guild_id, limit)
+        ).fetchall()
+        return [dict(row) for row in rows]
+
+    def peak_concurrency(self, since):
+        """Nombre maximal de serveurs jouant pendant une même minute depuis `since`"""
+        row = self._reader().execute(
+            """SELECT minute, guilds FROM concurrency_minutes
+               WHERE minute >= ? ORDER BY guilds DESC, minute LIMIT 1""",
+            (int(since // 60),)
+        ).fetchone()
+        if not row:
+            return {"peak": 0, "at": None}
+        return {"peak": row["guilds"], "at": row["minute"] * 60}
+
+    def p95_time_to_first_audio(self, since, guild_id=None):
+        """95e centile du délai demande -> premier son (ms), depuis `since`.
+
+        Ne compte que les demandes arrivées quand rien ne jouait (sinon l'attente
+        dans la file domine). Lu depuis l'histogramme horaire : précis à 10 % près.
+        """
+        rows = self._reader().execute(
+            """SELECT bucket, SUM(count) AS count FROM ttfa_hist
+               WHERE guild_id = ? AND hour >= ? GROUP BY bucket ORDER BY bucket""",
+            (self.ALL_GUILDS if guild_id is None else guild_id, int(since // 3600))
+        ).fetchall()
+        total = sum(row["count"] for row in rows)
+        if not total:
+            return {"p95_ms": None, "samples": 0}
+        threshold = total * 0.95
+        seen = 0
+        for row in rows:
+            seen += row["count"]
+            if seen >= threshold:
+                break
+        # Borne haute du seau : on surestime plutôt que de sous-estimer
+        return {"p95_ms": round(self.TTFA_BUCKET_BASE ** (row["bucket"] + 1), 1), "samples": total}
+
+history = HistoryStore(HISTORY_DB)
+
 # --- Audio Source Class ---
 class YTDLSource(discord.PCMVolumeTransformer):
     def __init__(self, source, *, data, volume=0.5):
@@ -84,19 +474,25 @@ class YTDLSource(discord.PCMVolumeTransformer):
         self.url = data.get('webpage_url', '#')
         self.thumbnail = data.get('thumbnail')
         self.duration = data.get('duration')
+        self.track_id = data.get('id') or self.url
+        self.resolution_ms = None
+        self.requested_at = None  # time.monotonic() de la demande
+        self.queued_idle = False  # ajouté alors que rien ne jouait
         self.uploader = data.get('uploader')
         self.requester = data.get('requester')
 
     @classmethod
     async def from_url(cls, url, *, loop=None, stream=True, requester=None):
         loop = loop or asyncio.get_event_loop()
-        
+        ytdl = await loop.run_in_executor(None, get_ytdl, governor.under_pressure())
+        from yt_dlp.utils import DownloadError
+
         try:
             data = await loop.run_in_executor(
                 None,
                 lambda: ytdl.extract_info(url, download=not stream)
             )
-        except yt_dlp.utils.DownloadError as e:
+        except DownloadError as e:
             raise ValueError(f"Could not process link. YTDL Error: {e}")
         except Exception as e:
             raise ValueError(f"An unexpected error occurred: {e}")
@@ -118,9 +514,20 @@ class YTDLSource(discord.PCMVolumeTransformer):
         return cls(audio_source, data=data)
 
     @classmethod
-    async def search(cls, query: str, *, loop=None, requester=None):
+    async def search(cls, query: str, *, loop=None, requester=None, requested_at=None):
         loop = loop or asyncio.get_event_loop()
-        
+        with governor.extraction():
+            t0 = time.monotonic()
+            source = await cls._search(query, loop=loop, requester=requester)
+            source.resolution_ms = (time.monotonic() - t0) * 1000
+            source.requested_at = requested_at or t0
+            return source
+
+    @classmethod
+    async def _search(cls, query: str, *, loop, requester=None):
+        ytdl = await loop.run_in_executor(None, get_ytdl, governor.under_pressure())
+        from yt_dlp.utils import DownloadError
+
         try:
             search_query = query if query.startswith(('https://', 'http://')) else f"ytsearch1:{query}"
             data = await loop.run_in_executor(
@@ -143,11 +550,109 @@ class YTDLSource(discord.PCMVolumeTransformer):
             
             raise ValueError("Could not find a playable video from the query.")
 
-        except yt_dlp.utils.DownloadError as e:
+        except DownloadError as e:
             raise ValueError(f"Could not find or process '{query}'. YTDL Error: {e}")
         except Exception as e:
             raise ValueError(f"An unexpected error occurred during search: {e}")
 
+# --- Fair Queue Class ---
+class FairQueue(asyncio.Queue):
+    """File partagée équitablement entre les demandeurs (weighted fair queueing).
+
+    Chaque morceau reçoit une étiquette virtuelle : max(dernière étiquette du
+    demandeur, temps virtuel) + 1/poids. Le tas trié par étiquette entrelace
+    les demandeurs ; put/get restent en O(log n).
+    """
+
+    def __init__(self, weights=None, maxsize=0):
+        self._weights = weights if weights is not None else {}  # demandeur -> poids (1.0 par défaut)
+        super().__init__(maxsize)
+
+    def _init(self, maxsize):
+        self._queue = []  # tas de (étiquette, séquence, source)
+        self._seq = itertools.count()
+        self._last_tag = {}  # demandeur -> dernière étiquette attribuée
+        self._virtual_time = 0.0
+
+    @staticmethod
+    def requester_key(source):
+        requester = getattr(source, 'requester', None)
+        if requester is None:
+            return None
+        return getattr(requester, 'id', None) or getattr(requester, 'name', None)
+
+    def _put(self, item):
+        key = self.requester_key(item)
+        start = max(self._last_tag.get(key, 0.0), self._virtual_time)
+        tag = start + 1.0 / self._weights.get(key, 1.0)
+        self._last_tag[key] = tag
+        heapq.heappush(self._queue, (tag, next(self._seq), item))
+
+    def _get(self):
+        tag, _, item = heapq.heappop(self._queue)
+        self._virtual_time = tag
+        if not self._queue:
+            # File vide : on repart de zéro pour éviter une dérive infinie
+            self._last_tag.clear()
+            self._virtual_time = 0.0
+        return item
+
+    def ordered(self, limit=None):
+        """Renvoie les morceaux dans l'ordre de lecture effectif"""
+        if limit is None:
+            entries = sorted(self._queue)
+        else:
+            entries = heapq.nsmallest(limit, self._queue)
+        return [item for _, _, item in entries]
+
+    def position(self, item):
+        """Position (1-based) d'un morceau dans l'ordre de lecture, ou None"""
+        for entry in self._queue:
+            if entry[2] is item:
+                return 1 + sum(1 for other in self._queue if other[:2] < entry[:2])
+        return None
+
+def parse_queue_weights(spec):
+    weights = {}
+    for entry in filter(None, (part.strip() for part in spec.split(','))):
+        try:
+            key, weight = entry.rsplit(':', 1)
+            weights[int(key) if key.isdigit() else key] = max(float(weight), 0.01)
+        except ValueError:
+            log.warning(f"Ignoring invalid FAIR_QUEUE_WEIGHTS entry: {entry!r}")
+    return weights
+
+DEFAULT_QUEUE_WEIGHTS = parse_queue_weights(FAIR_QUEUE_WEIGHTS)
+queue_weights = {}  # guild_id -> {demandeur: poids}, conservé d'un player à l'autre
+
+def guild_queue_weights(guild_id):
+    return queue_weights.setdefault(guild_id, dict(DEFAULT_QUEUE_WEIGHTS))
+
+# --- Player State Snapshot ---
+_snapshot_versions = itertools.count(1)  # global : un player recréé ne réutilise pas d'ETag
+_BOOT_ID = uuid.uuid4().hex[:8]  # distingue les ETags d'un redémarrage à l'autre
+
+class PlayerSnapshot(NamedTuple):
+    """État immuable d'un player, remplacé d'un bloc à chaque changement.
+
+    Lu par les handlers Flask sans verrou ni passage par la boucle d'événements.
+    Les dicts contenus ne sont jamais modifiés après publication.
+    """
+    version: int
+    playing: bool
+    volume: int
+    current: Optional[dict]
+    queue: tuple
+
+    def to_dict(self):
+        return {
+            "connected": True,
+            "playing": self.playing,
+            "volume": self.volume,
+            "current": self.current,
+            "queue": list(self.queue)
+        }
+
 # --- Music Player Class ---
 class MusicPlayer:
     def __init__(self, interaction: discord.Interaction):
@@ -155,12 +660,20 @@ class MusicPlayer:
         self.guild = interaction.guild
         self.channel = interaction.channel
         self.voice_client = interaction.guild.voice_client
-        self.queue = asyncio.Queue()
+        self.queue = FairQueue(guild_queue_weights(self.guild.id)) if QUEUE_MODE == 'fair' else asyncio.Queue()
         self.next = asyncio.Event()
         self.current_source = None
         self._loop_task = None
         self.volume = 0.5
         self.playing = False
+        self._end_reason = None  # 'skipped' / 'error' ; 'finished' par défaut
+        self._paused_at = None
+        self._paused_total = 0.0
+        self._session_released = False  # slot réservé par governor.admit_session()
+        self.pending = 0  # extractions en cours pour ce player
+        self._has_queued = False  # au moins un morceau ajouté depuis la création
+        self.snapshot = None
+        self.publish_state()
         self.heartbeat = self.bot.loop.create_task(voice_heartbeat(self))
 
         self._loop_task = self.bot.loop.create_task(self.player_loop())
@@ -191,31 +704,89 @@ class MusicPlayer:
 
             self.current_source = source
             self.playing = True
+            self._end_reason = None
+            self._paused_at = None
+            self._paused_total = 0.0
+            self.publish_state()
 
+            started_at = None
             try:
                 log.info(f"[{self.guild.id}] Playing: {source.title}")
                 self.voice_client.play(source, after=self.handle_after_play)
+                started_at = time.time()
+                ttfa_ms = (time.monotonic() - source.requested_at) * 1000 if source.queued_idle and source.requested_at else None
                 source.volume = self.volume
             except Exception as e:
                 log.error(f"[{self.guild.id}] Error playing source {source.title}: {e}\n{traceback.format_exc()}")
                 self.next.set()
 
-            await self.next.wait()
+            try:
+                await self.next.wait()
+            except asyncio.CancelledError:
+                self._end_reason = 'stopped'  # /stop, déconnexion ou inactivité
+                raise
+            finally:
+                if started_at is not None:
+                    self.record_play(source, started_at, ttfa_ms)
             log.debug(f"[{self.guild.id}] Song finished or skipped: {source.title}")
             self.current_source = None
             self.playing = False
+            self.publish_state()
+
+    def record_play(self, source, started_at, ttfa_ms):
+        ended_at = time.time()
+        if self._paused_at is not None:
+            self._paused_total += ended_at - self._paused_at
+        reason = self._end_reason or 'finished'
+        history.record({
+            "guild_id": self.guild.id,
+            "track_id": source.track_id,
+            "title": source.title,
+            "requester": source.requester.name if source.requester else "Dashboard",
+            "started_at": started_at,
+            "ended_at": ended_at,
+            "listened": max(0.0, ended_at - started_at - self._paused_total),
+            "skipped": int(reason in ('skipped', 'stopped')),
+            "resolution_ms": source.resolution_ms,
+            "ended_reason": reason,
+            "ttfa_ms": ttfa_ms
+        })
 
     def handle_after_play(self, error):
         if error:
             log.error(f"[{self.guild.id}] Error during playback: {error}")
+            self._end_reason = 'error'
         self.bot.loop.call_soon_threadsafe(self.next.set)
 
     async def add_to_queue(self, source: YTDLSource):
+        if players.get(self.guild.id) is not self:
+            # Player détruit pendant l'extraction : ne pas laisser ffmpeg orphelin
+            source.cleanup()
+            raise ValueError("The player was stopped while the song was loading. Please try again.")
+        self._has_queued = True
+        source.queued_idle = self.is_idle()
         await self.queue.put(source)
+        self.publish_state()
         log.info(f"[{self.guild.id}] Added to queue: {source.title} (Queue size: {self.queue.qsize()})")
 
+    async def search_and_queue(self, query, *, requester=None, requested_at=None):
+        """Résout puis ajoute un morceau ; libère la session si aucun premier morceau n'aboutit"""
+        self.pending += 1
+        try:
+            source = await YTDLSource.search(query, loop=self.bot.loop, requester=requester, requested_at=requested_at)
+            await self.add_to_queue(source)
+            return source
+        finally:
+            self.pending -= 1
+            # Premier morceau refusé ou introuvable : ne pas occuper le salon (ni le slot) pour rien
+            if not self._has_queued and not self.pending and self.is_idle() and players.get(self.guild.id) is self:
+                await self.destroy()
+
     async def destroy(self):
         log.info(f"[{self.guild.id}] Destroying music player.")
+        if not self._session_released:
+            self._session_released = True
+            governor.release_session()
         if self._loop_task:
             self._loop_task.cancel()
         while not self.queue.empty():
@@ -232,15 +803,22 @@ class MusicPlayer:
         if self.voice_client.is_playing():
             self.voice_client.pause()
             self.playing = False
+            self._paused_at = time.time()
+            self.publish_state()
             return False
         elif self.voice_client.is_paused():
             self.voice_client.resume()
             self.playing = True
+            if self._paused_at is not None:
+                self._paused_total += time.time() - self._paused_at
+                self._paused_at = None
+            self.publish_state()
             return True
         return self.playing
 
     async def skip_current(self):
         if self.voice_client.is_playing() or self.voice_client.is_paused():
+            self._end_reason = 'skipped'
             self.voice_client.stop()
             return True
         return False
@@ -249,20 +827,53 @@ class MusicPlayer:
         self.volume = volume / 100.0
         if self.voice_client and self.voice_client.source:
             self.voice_client.source.volume = self.volume
+        self.publish_state()
         return True
 
+    def is_idle(self):
+        return self.queue.empty() and not self.current_source
+
+    def upcoming(self, limit=None):
+        """Morceaux en attente dans l'ordre de lecture effectif"""
+        if isinstance(self.queue, FairQueue):
+            return self.queue.ordered(limit)
+        return list(itertools.islice(self.queue._queue, limit))
+
+    def queue_position(self, source):
+        """Position (1-based) dans la file, 0 si le morceau est déjà en lecture"""
+        if source is self.current_source:
+            return 0
+        if isinstance(self.queue, FairQueue):
+            return self.queue.position(source) or 0
+        return self.queue.qsize()
+
+    def publish_state(self):
+        """Construit un nouveau snapshot et le remplace atomiquement (boucle d'événements uniquement)"""
+        current_track = None
+        if self.current_source:
+            current_track = {
+                "title": self.current_source.title,
+                "url": self.current_source.url,
+                "thumbnail": self.current_source.thumbnail,
+                "duration": format_duration(self.current_source.duration),
+                "requester": self.current_source.requester.name if self.current_source.requester else "Dashboard"
+            }
+        self.snapshot = PlayerSnapshot(
+            version=next(_snapshot_versions),
+            playing=self.playing,
+            volume=int(self.volume * 100),
+            current=current_track,
+            queue=tuple(self.get_queue_info())
+        )
+
     def get_queue_info(self):
         queue_list = []
-        for i in range(self.queue.qsize()):
-            try:
-                source = self.queue._queue[i]
-                queue_list.append({
-                    "title": source.title,
-                    "url": source.url,
-                    "requester": source.requester.name if source.requester else "Unknown"
-                })
-            except:
-                pass
+        for source in self.upcoming():
+            queue_list.append({
+                "title": source.title,
+                "url": source.url,
+                "requester": source.requester.name if source.requester else "Unknown"
+            })
         return queue_list
 
 # --- Helper Functions ---
@@ -280,29 +891,44 @@ def format_duration(seconds: int):
         return "N/A"
 
 
+async def send_ephemeral(interaction: discord.Interaction, message: str):
+    if interaction.response.is_done():
+        await interaction.followup.send(message, ephemeral=True)
+    else:
+        await interaction.response.send_message(message, ephemeral=True)
+
 async def get_player(interaction: discord.Interaction) -> MusicPlayer:
     guild_id = interaction.guild.id
     if guild_id in players:
         return players[guild_id]
     else:
         if not interaction.user.voice or not interaction.user.voice.channel:
-            await interaction.response.send_message("You need to be in a voice channel to start playing music.", ephemeral=True)
+            await send_ephemeral(interaction, "You need to be in a voice channel to start playing music.")
             return None
 
         voice_channel = interaction.user.voice.channel
         permissions = voice_channel.permissions_for(interaction.guild.me)
         if not permissions.connect or not permissions.speak:
-            await interaction.response.send_message("I don't have permission to connect or speak in that channel.", ephemeral=True)
+            await send_ephemeral(interaction, "I don't have permission to connect or speak in that channel.")
+            return None
+
+        try:
+            governor.admit_session()
+        except ResourceBusy as e:
+            log.warning(f"Refusing new session for guild {guild_id}: {e}")
+            await send_ephemeral(interaction, f"⏳ {e}")
             return None
 
         try:
             voice_client = await voice_channel.connect()
         except discord.ClientException as e:
-            await interaction.response.send_message(f"Failed to connect to voice channel: {e}", ephemeral=True)
+            governor.release_session()
+            await send_ephemeral(interaction, f"Failed to connect to voice channel: {e}")
             return None
         except Exception as e:
+            governor.release_session()
             log.error(f"Unexpected error connecting to VC: {e}")
-            await interaction.response.send_message(f"An unexpected error occurred while connecting.", ephemeral=True)
+            await send_ephemeral(interaction, f"An unexpected error occurred while connecting.")
             return None
 
         players[guild_id] = MusicPlayer(interaction)
@@ -318,17 +944,59 @@ async def voice_heartbeat(player):
         elif not player.voice_client.is_playing():
             player.voice_client.stop()
 
+def command_tree_hash():
+    # L'application fait partie de l'empreinte : changer de TOKEN force une synchronisation
+    payload = {
+        "application_id": bot.application_id,
+        "commands": [cmd.to_dict(bot.tree) for cmd in bot.tree.get_commands()]
+    }
+    return hashlib.sha256(json.dumps(payload, sort_keys=True).encode()).hexdigest()
+
+_tree_synced = False
+
+async def sync_command_tree():
+    """Synchronise les slash commands uniquement si leur définition a changé"""
+    global _tree_synced
+    if _tree_synced:
+        return  # Reconnexion : déjà synchronisé dans ce processus
+
+    try:
+        current_hash = command_tree_hash()
+        try:
+            with open(TREE_HASH_FILE) as f:
+                previous_hash = f.read().strip()
+        except OSError:
+            previous_hash = None
+
+        if current_hash == previous_hash:
+            log.info('Slash commands unchanged, skipping sync.')
+        else:
+            synced = await bot.tree.sync()
+            log.info(f'Synced {len(synced)} slash commands.')
+            with open(TREE_HASH_FILE, 'w') as f:
+                f.write(current_hash)
+        _tree_synced = True
+    except Exception as e:
+        log.error(f"Failed to sync slash commands: {e}")
+
+_first_ready = True  # on_ready est aussi appelé à chaque reconnexion
+
 # --- Bot Events ---
 @bot.event
 async def on_ready():
     log.info(f'Logged in as {bot.user.name} ({bot.user.id})')
     log.info(f'Discord.py version: {discord.__version__}')
-    
-    try:
-        synced = await bot.tree.sync()
-        log.info(f'Synced {len(synced)} slash commands.')
-    except Exception as e:
-        log.error(f"Failed to sync slash commands: {e}")
+
+    global _first_ready
+    if _first_ready:
+        _first_ready = False
+        log.info(f'Ready in {time.perf_counter() - _START_TIME:.2f}s')
+
+        # Précharge yt_dlp hors de la boucle d'événements, après le démarrage
+        if not FAST_START:
+            bot.loop.run_in_executor(None, get_ytdl)
+
+    await sync_command_tree()
 
     await bot.change_presence(activity=discord.Activity(type=discord.ActivityType.listening, name="Tagilla 🤺"))
 
@@ -353,6 +1021,7 @@ async def on_voice_state_update(member, before, after):
 @bot.tree.command(name="play", description="Plays a song from YouTube, Spotify (via YT search), or URL.")
 @app_commands.describe(query="The song title, YouTube URL, or Spotify URL to play.")
 async def play(interaction: discord.Interaction, *, query: str):
+    requested_at = time.monotonic()
     await interaction.response.defer()
 
     player = await get_player(interaction)
@@ -360,8 +1029,7 @@ async def play(interaction: discord.Interaction, *, query: str):
         return
 
     try:
-        source = await YTDLSource.search(query, loop=bot.loop, requester=interaction.user)
-        await player.add_to_queue(source)
+        source = await player.search_and_queue(query, requester=interaction.user, requested_at=requested_at)
 
         embed = discord.Embed(
             title="✅ Added to Queue",
@@ -372,10 +1040,13 @@ async def play(interaction: discord.Interaction, *, query: str):
             embed.set_thumbnail(url=source.thumbnail)
         if source.duration:
             embed.add_field(name="Duration", value=format_duration(source.duration), inline=True)
-        embed.set_footer(text=f"Position in queue: {player.queue.qsize()}")
+        position = player.queue_position(source)
+        embed.set_footer(text=f"Position in queue: {position}" if position else "Now playing")
 
         await interaction.followup.send(embed=embed)
 
+    except ResourceBusy as e:
+        await interaction.followup.send(f"⏳ {e}", ephemeral=True)
     except ValueError as e:
         await interaction.followup.send(f"❌ Error: {e}", ephemeral=True)
     except Exception as e:
@@ -452,8 +1123,7 @@ async def queue(interaction: discord.Interaction):
 
     if not player.queue.empty():
         queue_list = []
-        for i in range(min(10, player.queue.qsize())):
-            source = player.queue._queue[i]
+        for i, source in enumerate(player.upcoming(10)):
             requester = source.requester
             queue_list.append(
                 f"`{i+1}.` **[{source.title}]({source.url})** | `{format_duration(source.duration)}` | Req by: {requester.mention if requester else 'Unknown'}"
@@ -496,6 +1166,17 @@ async def resume(interaction: discord.Interaction):
     else:
         await interaction.response.send_message("Nothing is currently playing.", ephemeral=True)
 
+@bot.tree.command(name="queueweight", description="Sets a member's share of the fair queue (admin only).")
+@app_commands.describe(member="The member whose share to change.", weight="Relative share (1 = normal, 2 = twice as many turns).")
+@app_commands.checks.has_permissions(manage_guild=True)
+async def queueweight(interaction: discord.Interaction, member: discord.Member, weight: app_commands.Range[float, 0.1, 10.0]):
+    if QUEUE_MODE != 'fair':
+        return await interaction.response.send_message("Fair queue mode is disabled (set QUEUE_MODE=fair).", ephemeral=True)
+
+    guild_queue_weights(interaction.guild.id)[member.id] = weight
+    log.info(f"[{interaction.guild.id}] Queue weight for {member.name} set to {weight} by {interaction.user.name}")
+    await interaction.response.send_message(f"⚖️ Queue weight for {member.mention} set to **{weight:g}** (applies to newly queued songs).")
+
 @bot.tree.command(name="ping", description="Checks the bot's latency.")
 async def ping(interaction: discord.Interaction):
     latency = bot.latency * 1000
@@ -540,29 +1221,52 @@ def get_status():
     if not player:
         return jsonify({"connected": False, "message": "Bot not connected in this server"})
 
-    current_track = None
-    if player.current_source:
-        current_track = {
-            "title": player.current_source.title,
-            "url": player.current_source.url,
-            "thumbnail": player.current_source.thumbnail,
-            "duration": format_duration(player.current_source.duration),
-            "requester": player.current_source.requester.name if player.current_source.requester else "Dashboard"
-        }
-
-    queue_info = player.get_queue_info()
-
-    return jsonify({
-        "connected": True,
-        "playing": player.playing,
-        "volume": int(player.volume * 100),
-        "current": current_track,
-        "queue": queue_info
-    })
+    # Une seule lecture de l'attribut : vue cohérente, sans verrou
+    snapshot = player.snapshot
+    response = jsonify(snapshot.to_dict())
+    response.set_etag(f"{_BOOT_ID}-{guild_id}-{snapshot.version}")
+    return response.make_conditional(request)
+
+@app.route('/resources', methods=['GET'])
+def get_resources():
+    """Renvoie la marge restante avant saturation (sessions, ffmpeg, CPU, RAM)"""
+    future = asyncio.run_coroutine_threadsafe(_headroom(), bot.loop)
+    return jsonify(future.result())
+
+async def _headroom():
+    return governor.headroom()
+
+def _since_param(default_hours=24):
+    hours = request.args.get('hours', default_hours, type=float)
+    if not math.isfinite(hours):
+        hours = default_hours
+    hours = min(max(hours, 0), MAX_STATS_HOURS)
+    return time.time() - hours * 3600
+
+@app.route('/stats/top_tracks', methods=['GET'])
+def get_top_tracks():
+    """Renvoie les morceaux les plus joués d'un serveur"""
+    guild_id = request.args.get('guild_id', type=int)
+    if guild_id is None:
+        return jsonify({"error": "Missing or invalid guild_id parameter"}), 400
+    limit = min(max(request.args.get('limit', 10, type=int), 1), 100)
+    return jsonify({"tracks": history.top_tracks(guild_id, limit)})
+
+@app.route('/stats/peak_concurrency', methods=['GET'])
+def get_peak_concurrency():
+    """Renvoie le pic de serveurs jouant simultanément sur la période (paramètre hours, 24 par défaut, 720 max)"""
+    return jsonify(history.peak_concurrency(_since_param()))
+
+@app.route('/stats/ttfa', methods=['GET'])
+def get_time_to_first_audio():
+    """Renvoie le p95 du temps avant le premier son sur la période"""
+    guild_id = request.args.get('guild_id', type=int)
+    return jsonify(history.p95_time_to_first_audio(_since_param(), guild_id))
 
 @app.route('/play', methods=['POST'])
 def play_music():
     """Ajoute une musique à la file d'attente"""
+    requested_at = time.monotonic()
     auth_token = request.headers.get('Authorization')
     if auth_token != f"Bearer {API_TOKEN}":
         return jsonify({"error": "Unauthorized"}), 401
@@ -602,28 +1306,35 @@ def play_music():
         async def add_music():
             nonlocal player
             if not player:
+                governor.admit_session()
+
                 # Connecter le bot au salon vocal
-                voice_client = await channel.connect()
+                try:
+                    voice_client = await channel.connect()
+                except Exception:
+                    governor.release_session()
+                    raise
                 
                 # Créer un player
                 player = MusicPlayer(mock_interaction)
                 players[guild.id] = player
                 
             # Ajouter la musique
-            source = await YTDLSource.search(url, loop=bot.loop, requester=mock_interaction.user)
-            await player.add_to_queue(source)
-            return source
+            source = await player.search_and_queue(url, requester=mock_interaction.user, requested_at=requested_at)
+            return source, player.queue_position(source)
 
         future = asyncio.run_coroutine_threadsafe(add_music(), bot.loop)
-        source = future.result()
+        source, position = future.result()
 
         return jsonify({
             "success": True,
             "message": "Music added to queue",
             "title": source.title,
-            "position": player.queue.qsize()
+            "position": position
         })
 
+    except ResourceBusy as e:
+        return jsonify({"success": False, "busy": True, "message": str(e)}), 503, {"Retry-After": "30"}
     except Exception as e:
         return jsonify({"success": False, "message": str(e)}), 500
 
@@ -751,6 +1462,9 @@ if __name__ == "__main__":
     if sys.platform == 'win32':
         asyncio.set_event_loop_policy(asyncio.WindowsSelectorEventLoopPolicy())
     
+    # Démarrer l'écriture de l'historique en arrière-plan
+    history.start()
+
     # Démarrer le serveur API dans un thread séparé
     flask_thread = Thread(target=run_flask)
     flask_thread.daemon = True